@@ -1,12 +1,29 @@
 import argparse
-import json
+import hashlib
+import posixpath
 import sys
-from copy import deepcopy
-from pathlib import Path
-from typing import Dict, Optional, Set, Union
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path, PurePosixPath
+from typing import (
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
+import orjson
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class ConfigAction(argparse.Action):
@@ -57,6 +74,13 @@ class ConfigAction(argparse.Action):
                 setattr(namespace, key, item)
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
 parser = argparse.ArgumentParser(conflict_handler="resolve")
 mutual_exlusion_group = parser.add_mutually_exclusive_group()
 parser.add_argument(
@@ -80,11 +104,14 @@ parser.add_argument(
     "Required unless specified in the config",
 )
 parser.add_argument(
-    "--host",
-    help="URL to the Immich instance. Example: http://localhost:2283"
+    "--host", help="URL to the Immich instance. Example: http://localhost:2283"
 )
 parser.add_argument(
-    "-l", "--library", nargs="+", help="List of library names to only run the script on", metavar="LIBRARY NAMES"
+    "-l",
+    "--library",
+    nargs="+",
+    help="List of library names to only run the script on",
+    metavar="LIBRARY NAMES",
 )
 parser.add_argument(
     "-f",
@@ -99,13 +126,27 @@ parser.add_argument(
     type=Path,
     default=[],
     help="List of paths to ignore. " 'Add "*" at the end to also ignore subfolders',
-    metavar="<paths to skip>"
+    metavar="<paths to skip>",
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    type=positive_int,
+    default=16,
+    help="Number of albums to sync at the same time. Defaults to %(default)s",
+    metavar="<number of workers>",
 )
 mutual_exlusion_group.add_argument(
     "-c",
     "--clean-update",
     action="store_true",
-    help="Also clear the album of wrongly indexed assets",
+    help="Also clear the album of wrongly indexed assets. "
+    "When using --json, albums whose assets are unchanged since their last clean are skipped",
+)
+mutual_exlusion_group.add_argument(
+    "--force-clean",
+    action="store_true",
+    help="Like --clean-update, but always check every album for wrongly indexed assets",
 )
 mutual_exlusion_group.add_argument(
     "--skip-existing", action="store_true", help="Ignore albums that already exist"
@@ -133,10 +174,11 @@ if not host.endswith("api"):
 
 json_folder_layout: Optional[dict] = None
 json_name_layout: Optional[dict] = None
+old_json_data: dict = {}
 if args.json is not None:
     if args.json.exists():
-        with open(args.json, "r") as json_file:
-            old_json_data: dict = json.load(json_file)
+        with open(args.json, "rb") as json_file:
+            old_json_data = orjson.loads(json_file.read())
             json_folder_layout = old_json_data.get("folder_layout", None)
             json_name_layout = old_json_data.get("name_layout", None)
     elif not args.json.parent.exists():
@@ -147,221 +189,354 @@ headers = {
     "Accept": "application/json",
     "x-api-key": args.api_key,
 }
+session = requests.Session()
+session.headers.update(headers)
+adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=max(32, args.workers),
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 502, 503, 504],
+        raise_on_status=False,
+    ),
+)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+search_adapter = HTTPAdapter(
+    max_retries=Retry(
+        total=10,
+        backoff_factor=1.0,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False,
+    ),
+)
+session.mount(host + "/search/", search_adapter)
+
 print("Making API Requests")
 print()
-libraries = requests.get(
-    host + "/library", headers=headers, params={"type": "EXTERNAL"}
-).json()
+with ThreadPoolExecutor(max_workers=2) as executor:
+    library_future = executor.submit(
+        session.get, host + "/library", params={"type": "EXTERNAL"}
+    )
+    album_future = executor.submit(session.get, host + "/album")
+
+libraries = orjson.loads(library_future.result().content)
 print(f"Found {len(libraries)} Libraries")
+lib_id_to_name = {l["id"]: l["name"] for l in libraries}
+lib_name_to_id = {l["name"]: l["id"] for l in libraries}
 if args.library is not None:
-    library_filter = []
-    library_names = [x["name"] for x in libraries]
-
     for item in args.library:
-        if item not in library_names:
+        if item not in lib_name_to_id:
             print(f'Unable to find a library by the name of "{item}"')
             sys.exit()
 
-        library_filter.append(
-            next((l["id"] for l in libraries if l["name"] == item), "")
-        )
+    library_filter = {lib_name_to_id[item] for item in args.library}
 else:
-    library_filter = [x["id"] for x in libraries]
+    library_filter = {x["id"] for x in libraries}
 
-albums: dict = requests.get(host + "/album", headers=headers).json()
+albums: dict = orjson.loads(album_future.result().content)
 print(f"Found {len(albums)} Albums")
-assets: dict = requests.get(host + "/asset", headers=headers).json()
-print(f"Found {len(assets)} Assets")
-print()
 
-album_names = [a["albumName"] for a in albums]
-album_ids = [a["id"] for a in albums]
-skip_paths = {"direct": [], "recursive": []}
+
+def fetch_assets(library_ids: Iterable[str]) -> Iterator[dict]:
+    for library_id in library_ids:
+        page = 1
+        while page is not None:
+            r = session.post(
+                host + "/search/metadata",
+                data=orjson.dumps(
+                    {
+                        "page": page,
+                        "size": 1000,
+                        "libraryId": library_id,
+                        "withArchived": True,
+                    }
+                ),
+            )
+            if not r.ok:
+                sys.exit(
+                    f"[ERROR] Fetching assets failed with error code: {r.status_code} {r.reason}"
+                )
+
+            result = orjson.loads(r.content)["assets"]
+            yield from result["items"]
+            next_page = result["nextPage"]
+            page = int(next_page) if next_page else None
+
+
+assets = fetch_assets(library_filter)
+
+album_names = {a["albumName"] for a in albums}
+album_ids = {a["id"] for a in albums}
+skip_direct: Set[str] = set()
+skip_recursive: Set[str] = set()
 for p in args.skip_paths:
     if p.stem == "*":
-        skip_paths["recursive"].append(p.parent)
+        skip_recursive.add(p.parent.as_posix().rstrip("/") + "/")
     else:
-        skip_paths["direct"].append(p)
+        skip_direct.add(p.as_posix())
+skip_prefixes = tuple(skip_recursive)
+
+
+print_lock = threading.Lock()
+
+
+def log(*values) -> None:
+    with print_lock:
+        print(*values)
 
 
-def create_album() -> None:
+def error_message(r: requests.Response) -> str:
+    try:
+        msg = orjson.loads(r.content)["message"]
+    except (ValueError, KeyError, TypeError):
+        return r.text
+    if isinstance(msg, list):
+        msg = msg[0]
+    return msg
+
+
+def _chunks(lst: List[str], n: int) -> Iterator[List[str]]:
+    return (lst[i : i + n] for i in range(0, len(lst), n))
+
+
+def create_album(album_name: str, asset_ids_list: List[str]) -> Optional[str]:
     if args.skip_existing and args.json is None:
         if album_name in album_names:
-            print(f'Album "{album_name}" already exists. Skipping')
-            return
+            log(f'Album "{album_name}" already exists. Skipping')
+            return None
 
-    payload = json.dumps({"albumName": album_name, "assetIds": list(asset_ids)})
-    r = requests.post(host + "/album", headers=headers, data=payload)
+    r = session.post(
+        host + "/album",
+        data=orjson.dumps({"albumName": album_name, "assetIds": asset_ids_list}),
+    )
     if r.ok:
-        print(f'Created album "{album_name}" with {len(asset_ids)} assets')
-        if args.json:
-            json_output.update({update_key: r.json()["id"]})
-    else:
-        print(
-            f'[ERROR] Creation of album "{album_name}" failed with error code: {r.status_code} {r.reason}'
-        )
-        print(r.json()["message"][0])
+        log(f'Created album "{album_name}" with {len(asset_ids_list)} assets')
+        return orjson.loads(r.content)["id"]
+
+    log(
+        f'[ERROR] Creation of album "{album_name}" failed with error code: {r.status_code} {r.reason}'
+    )
+    log(error_message(r))
+    return None
 
 
-def update_album() -> None:
+def update_album(album_name: str, asset_ids_list: List[str], album_id: str) -> None:
     if args.skip_existing and album_id in album_ids:
-        print(f'Album "{album_name}" already exists. Skipping')
+        log(f'Album "{album_name}" already exists. Skipping')
         return
 
-    payload = json.dumps({"ids": list(asset_ids)})
-    r = requests.put(
-        host + "/album" + f"/{album_id}" + "/assets", headers=headers, data=payload
-    )
-    if r.ok:
-        count = 0
-        for a in r.json():
+    count = 0
+    for chunk in _chunks(asset_ids_list, 500):
+        r = session.put(
+            host + "/album" + f"/{album_id}" + "/assets",
+            data=orjson.dumps({"ids": chunk}),
+        )
+        if not r.ok:
+            log(
+                f'[ERROR] Updating album "{album_name}" failed with error code: {r.status_code} {r.reason}'
+            )
+            log(error_message(r))
+            return
+
+        for a in orjson.loads(r.content):
             if a["success"]:
                 count += 1
-        if count == 0:
-            print(f'Album "{album_name}" is already up to date.')
-        else:
-            print(
-                f'Added {count} asset{"s" if count > 1 else ""} to the album "{album_name}"'
-            )
+
+    if count == 0:
+        log(f'Album "{album_name}" is already up to date.')
     else:
-        print(
-            f'[ERROR] Updating album "{album_name}" failed with error code: {r.status_code} {r.reason}'
+        log(
+            f'Added {count} asset{"s" if count > 1 else ""} to the album "{album_name}"'
         )
-        msg = r.json()["message"]
-        if isinstance(msg, list):
-            msg = msg[0]
-        print(msg)
 
 
-def clean_album() -> None:
-    r = requests.get(host + "/album" + f"/{album_id}", headers=headers)
+def clean_album(album_name: str, asset_ids: Set[str], album_id: str) -> bool:
+    r = session.get(host + "/album" + f"/{album_id}")
     if r.ok:
-        album_assets = r.json()
-        removal_assets = set([a["id"] for a in album_assets["assets"]])
-        removal_assets.difference_update(asset_ids)
+        album_assets = orjson.loads(r.content)
+        removal_assets = {a["id"] for a in album_assets["assets"]} - asset_ids
     else:
-        print(
+        log(
             f'[ERROR] Clearing album "{album_name} failed with error code: {r.status_code} {r.reason}"'
         )
-        print(r.json()["message"])
-        return
+        log(error_message(r))
+        return False
+
+    if not removal_assets:
+        return True
+
+    count = 0
+    cleaned = True
+    for chunk in _chunks(list(removal_assets), 500):
+        r = session.delete(
+            host + "/album" + f"/{album_id}" + "/assets",
+            data=orjson.dumps({"ids": chunk}),
+        )
+        if not r.ok:
+            cleaned = False
+            break
 
-    payload = json.dumps({"ids": list(removal_assets)})
-    r = requests.delete(
-        host + "/album" + f"/{album_id}" + "/assets", headers=headers, data=payload
-    )
-    if r.ok:
-        count = 0
-        for a in r.json():
+        for a in orjson.loads(r.content):
             if a["success"]:
                 count += 1
-        if count != 0:
-            print(f'Cleared {count} asset{"s" if count > 1 else ""} from "{album_name}"')
 
+    if count != 0:
+        log(f'Cleared {count} asset{"s" if count > 1 else ""} from "{album_name}"')
+    return cleaned
 
-json_output = {}
 
-if args.folder_layout:
-    folder_assets: Dict[Path, Set[str]] = {}
+def hash_assets(sorted_ids: List[str]) -> str:
+    return hashlib.sha1("\n".join(sorted_ids).encode()).hexdigest()
 
-    if json_folder_layout is not None:
-        json_output = deepcopy(json_folder_layout)
 
+def sync_album(
+    album_name: str,
+    asset_ids: Set[str],
+    stored: Union[str, dict, None],
+    update_key: str,
+) -> Tuple[str, Optional[dict]]:
+    album_id = stored
+    stored_hash = None
+    if isinstance(stored, dict):
+        album_id = stored.get("id")
+        stored_hash = stored.get("asset_hash")
+
+    asset_hash = None
+    if args.json is not None:
+        asset_ids_list = sorted(asset_ids)
+        asset_hash = hash_assets(asset_ids_list)
+    else:
+        asset_ids_list = list(asset_ids)
+
+    if isinstance(album_id, str) and album_id in album_ids:
+        # The stored hash marks the asset set the album was last cleaned against
+        if not (args.clean_update or args.force_clean):
+            if asset_hash != stored_hash:
+                asset_hash = None
+        elif args.force_clean or asset_hash is None or asset_hash != stored_hash:
+            if not clean_album(album_name, asset_ids, album_id):
+                asset_hash = None
+        update_album(album_name, asset_ids_list, album_id)
+        return update_key, {"id": album_id, "asset_hash": asset_hash}
+
+    album_id = create_album(album_name, asset_ids_list)
+    if album_id is None:
+        return update_key, None
+    return update_key, {"id": album_id, "asset_hash": asset_hash}
+
+
+def group_assets(
+    assets: Iterable[dict],
+    library_filter: Set[str],
+    skip_direct: Set[str],
+    skip_prefixes: Tuple[str, ...],
+    group_key: Callable[[dict, str], str],
+) -> DefaultDict[str, Set[str]]:
+    grouped_assets: DefaultDict[str, Set[str]] = defaultdict(set)
+
+    dirname = posixpath.dirname
+    asset_count = 0
     for asset in assets:
+        asset_count += 1
         if asset["libraryId"] not in library_filter:
             continue
 
-        path = Path(asset["originalPath"]).parent
-        if path in skip_paths["direct"]:
+        parent_str = dirname(asset["originalPath"])
+        if parent_str in skip_direct:
             continue
-        if [p for p in path.parents if p in skip_paths["recursive"]]:
+        if parent_str.startswith(skip_prefixes):
             continue
 
-        try:
-            folder_assets[path]
-        except:
-            folder_assets[path] = set()
-        finally:
-            folder_assets[path].add(asset["id"])
-
-    for path, path_items in folder_assets.items():
-        album_name = path.stem
-        asset_ids = path_items
-        update_key = str(path)
-        json_output[update_key] = {}
+        grouped_assets[group_key(asset, parent_str)].add(asset["id"])
+
+    print(f"Found {asset_count} Assets")
+    print()
+    return grouped_assets
+
+
+def sync_albums(
+    grouped_assets: Dict[str, Set[str]],
+    album_name_for: Callable[[str], str],
+    json_layout: Optional[dict],
+    workers: int,
+) -> dict:
+    json_output = {}
+    if json_layout is not None:
+        json_output = dict(json_layout)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for update_key, asset_ids in grouped_assets.items():
+            stored = None
+            if json_layout:
+                stored = json_layout.get(update_key)
+                legacy_key = str(Path(update_key))
+                if stored is None and legacy_key != update_key:
+                    stored = json_output.pop(legacy_key, None)
+
+            album_name = album_name_for(update_key)
+            future = executor.submit(
+                sync_album, album_name, asset_ids, stored, update_key
+            )
+            futures[future] = (album_name, update_key, stored)
 
-        if json_folder_layout is not None:
+        for future in as_completed(futures):
+            album_name, update_key, stored = futures[future]
             try:
-                album_id = json_folder_layout[update_key]
-            except:
-                pass
-            else:
-                if album_id in album_ids:
-                    if args.clean_update:
-                        clean_album()
-                    json_output.update({update_key: album_id})
-                    update_album()
-                    continue
-
-        create_album()
-else:
-    name_assets: Dict[str, Dict[str, Set[Union[Path, str]]]] = {}
+                update_key, entry = future.result()
+            except (requests.RequestException, ValueError) as e:
+                log(f'[ERROR] Syncing album "{album_name}" failed: {e}')
+                if stored is not None:
+                    json_output[update_key] = stored
+                continue
 
-    if json_name_layout is not None:
-        json_output = deepcopy(json_name_layout)
+            json_output[update_key] = entry
 
-    for asset in assets:
-        if asset["libraryId"] not in library_filter:
-            continue
+    return json_output
 
-        path = Path(asset["originalPath"]).parent
-        if path in skip_paths["direct"]:
-            continue
-        if [p for p in path.parents if p in skip_paths["recursive"]]:
-            continue
 
-        try:
-            name_assets[asset["libraryId"]]
-        except:
-            name_assets[asset["libraryId"]] = {"paths": set(), "ids": set()}
-        finally:
-            name_assets[asset["libraryId"]]["paths"].add(path)
-            name_assets[asset["libraryId"]]["ids"].add(asset["id"])
-
-    for lib_id, lib_items in name_assets.items():
-        album_name = next((l["name"] for l in libraries if l["id"] == lib_id), "")
-        asset_ids = lib_items["ids"]
-        update_key = lib_id
-        json_output[update_key] = {}
-
-        if json_name_layout is not None:
-            try:
-                album_id = json_name_layout[update_key]
-            except:
-                pass
-            else:
-                if album_id in album_ids:
-                    if args.clean_update:
-                        clean_album()
-                    json_output.update({update_key: album_id})
-                    update_album()
-                    continue
-
-        create_album()
+if args.folder_layout:
+    json_output = sync_albums(
+        group_assets(
+            assets,
+            library_filter,
+            skip_direct,
+            skip_prefixes,
+            lambda asset, folder: folder,
+        ),
+        lambda folder: PurePosixPath(folder).stem,
+        json_folder_layout,
+        args.workers,
+    )
+else:
+    json_output = sync_albums(
+        group_assets(
+            assets,
+            library_filter,
+            skip_direct,
+            skip_prefixes,
+            lambda asset, folder: asset["libraryId"],
+        ),
+        lambda lib_id: lib_id_to_name.get(lib_id, ""),
+        json_name_layout,
+        args.workers,
+    )
 
 if args.json is not None:
-    try:
-        json_data = old_json_data
-    except:
-        json_data = {}
+    json_data = old_json_data
 
     if args.folder_layout:
         json_data.update({"folder_layout": json_output})
     else:
         json_data.update({"name_layout": json_output})
 
-    with open(args.json, "w+") as json_file:
-        json.dump(json_data, json_file, indent=4)
+    with open(args.json, "wb") as json_file:
+        json_file.write(
+            orjson.dumps(json_data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        )
 
 print()
 print("Done!")